@@ -1,16 +1,23 @@
 """
-Simplified FastAPI backend using only OpenRouter API via requests.
+Simplified FastAPI backend using only OpenRouter API via httpx.
 No OpenAI SDK dependencies.
 """
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
-from uuid import uuid4
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, nullcontext
+from dataclasses import fields
+import asyncio
+import re
+import secrets
 import time
+import weakref
 import logging
 
 from simple_agents import (
+    AirlineAgentContext,
     triage_agent,
     faq_agent,
     seat_booking_agent,
@@ -19,13 +26,21 @@ from simple_agents import (
     create_initial_context,
     get_agent_by_name,
     setup_context_for_agent,
+    openrouter_client,
+    HISTORY_WINDOW,
 )
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    openrouter_client.start()
+    yield
+    await openrouter_client.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS configuration
 app.add_middleware(
@@ -77,14 +92,40 @@ class ChatResponse(BaseModel):
 # In-memory store for conversation state
 # =========================
 
+# Context attributes compared before/after an agent turn to report changes
+_CTX_FIELDS = tuple(f.name for f in fields(AirlineAgentContext))
+
+# Upper bound on stored conversations
+MAX_CONVERSATIONS = 10_000
+
 class InMemoryConversationStore:
-    _conversations: Dict[str, Dict[str, Any]] = {}
+    """LRU-bounded store; the least recently used conversation is evicted first."""
+
+    def __init__(self, max_conversations: int = MAX_CONVERSATIONS):
+        self._conversations: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # Held only while a turn is in flight, so idle or failed conversations leave nothing behind
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        self._max_conversations = max_conversations
 
     def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
-        return self._conversations.get(conversation_id)
+        state = self._conversations.get(conversation_id)
+        if state is not None:
+            self._conversations.move_to_end(conversation_id)
+        return state
 
     def save(self, conversation_id: str, state: Dict[str, Any]):
         self._conversations[conversation_id] = state
+        self._conversations.move_to_end(conversation_id)
+        if len(self._conversations) > self._max_conversations:
+            self._conversations.popitem(last=False)
+
+    def lock(self, conversation_id: str) -> asyncio.Lock:
+        """Lock serializing turns within a single conversation."""
+        lock = self._locks.get(conversation_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[conversation_id] = lock
+        return lock
 
 conversation_store = InMemoryConversationStore()
 
@@ -92,57 +133,69 @@ conversation_store = InMemoryConversationStore()
 # Helpers
 # =========================
 
-def _build_agents_list() -> List[Dict[str, Any]]:
-    """Build a list of all available agents and their metadata."""
-    return [
-        {
-            "name": "Triage Agent",
-            "description": "A triage agent that can delegate a customer's request to the appropriate agent.",
-            "handoffs": ["Seat Booking Agent", "Flight Status Agent", "Cancellation Agent", "FAQ Agent"],
-            "tools": [],
-            "input_guardrails": ["Relevance Guardrail", "Jailbreak Guardrail"],
-        },
-        {
-            "name": "Seat Booking Agent",
-            "description": "A helpful agent that can update a seat on a flight.",
-            "handoffs": ["Triage Agent"],
-            "tools": ["update_seat", "display_seat_map"],
-            "input_guardrails": ["Relevance Guardrail", "Jailbreak Guardrail"],
-        },
-        {
-            "name": "Flight Status Agent",
-            "description": "An agent to provide flight status information.",
-            "handoffs": ["Triage Agent"],
-            "tools": ["flight_status_tool"],
-            "input_guardrails": ["Relevance Guardrail", "Jailbreak Guardrail"],
-        },
-        {
-            "name": "Cancellation Agent",
-            "description": "An agent to cancel flights.",
-            "handoffs": ["Triage Agent"],
-            "tools": ["cancel_flight"],
-            "input_guardrails": ["Relevance Guardrail", "Jailbreak Guardrail"],
-        },
-        {
-            "name": "FAQ Agent",
-            "description": "A helpful agent that can answer questions about the airline.",
-            "handoffs": ["Triage Agent"],
-            "tools": ["faq_lookup_tool"],
-            "input_guardrails": ["Relevance Guardrail", "Jailbreak Guardrail"],
-        },
-    ]
+# All available agents and their metadata; built once and shared by every response
+_AGENTS_LIST: List[Dict[str, Any]] = [
+    {
+        "name": "Triage Agent",
+        "description": "A triage agent that can delegate a customer's request to the appropriate agent.",
+        "handoffs": ["Seat Booking Agent", "Flight Status Agent", "Cancellation Agent", "FAQ Agent"],
+        "tools": [],
+        "input_guardrails": ["Relevance Guardrail", "Jailbreak Guardrail"],
+    },
+    {
+        "name": "Seat Booking Agent",
+        "description": "A helpful agent that can update a seat on a flight.",
+        "handoffs": ["Triage Agent"],
+        "tools": ["update_seat", "display_seat_map"],
+        "input_guardrails": ["Relevance Guardrail", "Jailbreak Guardrail"],
+    },
+    {
+        "name": "Flight Status Agent",
+        "description": "An agent to provide flight status information.",
+        "handoffs": ["Triage Agent"],
+        "tools": ["flight_status_tool"],
+        "input_guardrails": ["Relevance Guardrail", "Jailbreak Guardrail"],
+    },
+    {
+        "name": "Cancellation Agent",
+        "description": "An agent to cancel flights.",
+        "handoffs": ["Triage Agent"],
+        "tools": ["cancel_flight"],
+        "input_guardrails": ["Relevance Guardrail", "Jailbreak Guardrail"],
+    },
+    {
+        "name": "FAQ Agent",
+        "description": "A helpful agent that can answer questions about the airline.",
+        "handoffs": ["Triage Agent"],
+        "tools": ["faq_lookup_tool"],
+        "input_guardrails": ["Relevance Guardrail", "Jailbreak Guardrail"],
+    },
+]
+
+# Guardrail keywords, each set compiled into a single alternation matched against the lowercased message
+AIRLINE_KEYWORDS = ["flight", "seat", "baggage", "cancel", "status", "book", "ticket", "airline", "plane", "gate"]
+JAILBREAK_PATTERNS = ["system prompt", "instructions", "ignore", "override", "bypass", "admin", "root"]
+_AIRLINE_KEYWORDS_RE = re.compile("|".join(map(re.escape, AIRLINE_KEYWORDS)))
+_JAILBREAK_PATTERNS_RE = re.compile("|".join(map(re.escape, JAILBREAK_PATTERNS)))
+
+def _ids(n: int) -> List[str]:
+    """Generate n random 32-char hex ids from a single entropy read."""
+    raw = secrets.token_hex(16 * n)
+    return [raw[i * 32:(i + 1) * 32] for i in range(n)]
 
-def check_guardrails(message: str) -> List[GuardrailCheck]:
+def check_guardrails(message: str, timestamp: Optional[float] = None) -> List[GuardrailCheck]:
     """Simple guardrail checks."""
     guardrails = []
-    timestamp = time.time() * 1000
+    if timestamp is None:
+        timestamp = time.time() * 1000
+    ids = _ids(2)
+    low = message.lower()
     
     # Relevance check
-    airline_keywords = ["flight", "seat", "baggage", "cancel", "status", "book", "ticket", "airline", "plane", "gate"]
-    is_relevant = any(keyword in message.lower() for keyword in airline_keywords) or len(message.strip()) < 10
+    is_relevant = _AIRLINE_KEYWORDS_RE.search(low) is not None or len(message.strip()) < 10
     
     guardrails.append(GuardrailCheck(
-        id=uuid4().hex,
+        id=ids[0],
         name="Relevance Guardrail",
         input=message,
         reasoning="Message contains airline-related keywords" if is_relevant else "Message does not seem related to airline services",
@@ -151,11 +204,10 @@ def check_guardrails(message: str) -> List[GuardrailCheck]:
     ))
     
     # Jailbreak check
-    jailbreak_patterns = ["system prompt", "instructions", "ignore", "override", "bypass", "admin", "root"]
-    is_safe = not any(pattern in message.lower() for pattern in jailbreak_patterns)
+    is_safe = _JAILBREAK_PATTERNS_RE.search(low) is None
     
     guardrails.append(GuardrailCheck(
-        id=uuid4().hex,
+        id=ids[1],
         name="Jailbreak Guardrail",
         input=message,
         reasoning="No jailbreak attempt detected" if is_safe else "Potential jailbreak attempt detected",
@@ -177,120 +229,127 @@ async def chat_endpoint(req: ChatRequest):
         is_new = not req.conversation_id or conversation_store.get(req.conversation_id) is None
         
         if is_new:
-            conversation_id: str = uuid4().hex
+            conversation_id: str = _ids(1)[0]
             ctx = create_initial_context()
             current_agent_name = "Triage Agent"
             state: Dict[str, Any] = {
-                "conversation_history": [],
+                "conversation_history": deque(maxlen=HISTORY_WINDOW),
                 "context": ctx,
                 "current_agent": current_agent_name,
             }
-            
-            if req.message.strip() == "":
-                conversation_store.save(conversation_id, state)
-                return ChatResponse(
-                    conversation_id=conversation_id,
-                    current_agent=current_agent_name,
-                    messages=[],
-                    events=[],
-                    context=ctx.model_dump(),
-                    agents=_build_agents_list(),
-                    guardrails=[],
-                )
         else:
             conversation_id = req.conversation_id
             state = conversation_store.get(conversation_id)
             if not state:
                 raise HTTPException(status_code=404, detail="Conversation not found")
         
-        # Check guardrails
-        guardrails = check_guardrails(req.message)
-        failed_guardrail = next((g for g in guardrails if not g.passed), None)
-        
-        if failed_guardrail:
-            refusal = "Sorry, I can only answer questions related to airline travel."
-            state["conversation_history"].append({"role": "user", "content": req.message})
-            state["conversation_history"].append({"role": "assistant", "content": refusal})
-            
+        # Empty messages skip guardrails and the agent entirely
+        if req.message.strip() == "":
             conversation_store.save(conversation_id, state)
-            
             return ChatResponse(
                 conversation_id=conversation_id,
                 current_agent=state["current_agent"],
-                messages=[MessageResponse(content=refusal, agent=state["current_agent"])],
+                messages=[],
                 events=[],
-                context=state["context"].model_dump(),
-                agents=_build_agents_list(),
-                guardrails=guardrails,
+                context=state["context"].to_dict(),
+                agents=_AGENTS_LIST,
+                guardrails=[],
             )
         
-        # Process with current agent
-        current_agent = get_agent_by_name(state["current_agent"])
-        old_context = state["context"].model_dump().copy()
-        
-        # Add user message to history
-        state["conversation_history"].append({"role": "user", "content": req.message})
-        
-        # Get agent response
-        result = current_agent.process_message(
-            req.message, 
-            state["context"], 
-            state["conversation_history"]
-        )
+        now_ms = time.time() * 1000
         
-        # Add assistant response to history
-        state["conversation_history"].append({"role": "assistant", "content": result["response"]})
-        
-        messages = [MessageResponse(content=result["response"], agent=current_agent.name)]
-        events = []
-        
-        # Process events
-        for event in result["events"]:
-            events.append(AgentEvent(
-                id=uuid4().hex,
-                type=event["type"],
-                agent=event["agent"],
-                content=event["content"],
-                metadata=event.get("metadata"),
-                timestamp=time.time() * 1000,
-            ))
+        # Serialize turns within the same conversation; a freshly generated id cannot be contended
+        async with nullcontext() if is_new else conversation_store.lock(conversation_id):
+            # Check guardrails
+            guardrails = check_guardrails(req.message, now_ms)
+            failed_guardrail = next((g for g in guardrails if not g.passed), None)
             
-            # Handle special seat map message
-            if event["type"] == "tool_output" and event["content"] == "DISPLAY_SEAT_MAP":
-                messages.append(MessageResponse(content="DISPLAY_SEAT_MAP", agent=current_agent.name))
-        
-        # Handle handoffs
-        if result.get("handoff_to"):
-            new_agent = result["handoff_to"]
-            state["current_agent"] = new_agent.name
-            setup_context_for_agent(state["context"], new_agent.name)
-            current_agent = new_agent
-        
-        # Check for context changes
-        new_context = state["context"].model_dump()
-        changes = {k: new_context[k] for k in new_context if old_context.get(k) != new_context[k]}
-        if changes:
-            events.append(AgentEvent(
-                id=uuid4().hex,
-                type="context_update",
-                agent=current_agent.name,
-                content="",
-                metadata={"changes": changes},
-                timestamp=time.time() * 1000,
-            ))
-        
-        # Save state
-        conversation_store.save(conversation_id, state)
-        
-        return ChatResponse(
-            conversation_id=conversation_id,
-            current_agent=current_agent.name,
-            messages=messages,
-            events=events,
-            context=state["context"].model_dump(),
-            agents=_build_agents_list(),
-            guardrails=guardrails,
-        )
+            if failed_guardrail:
+                refusal = "Sorry, I can only answer questions related to airline travel."
+                state["conversation_history"].append({"role": "user", "content": req.message})
+                state["conversation_history"].append({"role": "assistant", "content": refusal})
+            
+                conversation_store.save(conversation_id, state)
+            
+                return ChatResponse(
+                    conversation_id=conversation_id,
+                    current_agent=state["current_agent"],
+                    messages=[MessageResponse(content=refusal, agent=state["current_agent"])],
+                    events=[],
+                    context=state["context"].to_dict(),
+                    agents=_AGENTS_LIST,
+                    guardrails=guardrails,
+                )
+            
+            # Process with current agent
+            current_agent = get_agent_by_name(state["current_agent"])
+            old_values = tuple(getattr(state["context"], f) for f in _CTX_FIELDS)
+            
+            # Add user message to history
+            state["conversation_history"].append({"role": "user", "content": req.message})
+            
+            # Get agent response
+            result = await current_agent.process_message(
+                req.message, 
+                state["context"], 
+                state["conversation_history"]
+            )
+            
+            # Add assistant response to history
+            state["conversation_history"].append({"role": "assistant", "content": result["response"]})
+            
+            messages = [MessageResponse(content=result["response"], agent=current_agent.name)]
+            events = []
+            event_ids = _ids(len(result["events"]) + 1)
+            events_ms = time.time() * 1000
+            
+            # Process events
+            for i, event in enumerate(result["events"]):
+                events.append(AgentEvent(
+                    id=event_ids[i],
+                    type=event["type"],
+                    agent=event["agent"],
+                    content=event["content"],
+                    metadata=event.get("metadata"),
+                    timestamp=events_ms,
+                ))
+            
+                # Handle special seat map message
+                if event["type"] == "tool_output" and event["content"] == "DISPLAY_SEAT_MAP":
+                    messages.append(MessageResponse(content="DISPLAY_SEAT_MAP", agent=current_agent.name))
+            
+            # Handle handoffs
+            if result.get("handoff_to"):
+                new_agent = result["handoff_to"]
+                state["current_agent"] = new_agent.name
+                setup_context_for_agent(state["context"], new_agent.name)
+                current_agent = new_agent
+            
+            # Check for context changes
+            new_values = tuple(getattr(state["context"], f) for f in _CTX_FIELDS)
+            changes = {f: new for f, old, new in zip(_CTX_FIELDS, old_values, new_values) if old != new}
+            if changes:
+                events.append(AgentEvent(
+                    id=event_ids[-1],
+                    type="context_update",
+                    agent=current_agent.name,
+                    content="",
+                    metadata={"changes": changes},
+                    timestamp=events_ms,
+                ))
+            
+            # Save state
+            conversation_store.save(conversation_id, state)
+            
+            return ChatResponse(
+                conversation_id=conversation_id,
+                current_agent=current_agent.name,
+                messages=messages,
+                events=events,
+                context=state["context"].to_dict(),
+                agents=_AGENTS_LIST,
+                guardrails=guardrails,
+            )
         
     except Exception as e:
         logger.error(f"Error in chat endpoint: {e}")
@@ -1,21 +1,26 @@
 """
-Simple agent system using only OpenRouter API via requests.
+Simple agent system using only OpenRouter API via httpx.
 No OpenAI SDK dependencies.
 """
 import os
-import requests
+import asyncio
+import httpx
+import inspect
 import json
+import orjson
 import random
+import re
 import string
-from typing import Any, Dict, List, Optional, Callable
-from pydantic import BaseModel
+from typing import Any, Dict, List, Optional, Callable, Sequence
+from dataclasses import dataclass
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 
-class AirlineAgentContext(BaseModel):
+@dataclass(slots=True)
+class AirlineAgentContext:
     """Context for airline customer service agents."""
     passenger_name: str | None = None
     confirmation_number: str | None = None
@@ -23,45 +28,149 @@ class AirlineAgentContext(BaseModel):
     flight_number: str | None = None
     account_number: str | None = None
 
+    def to_dict(self) -> Dict[str, Any]:
+        """Return the context as a plain dict."""
+        return {
+            "passenger_name": self.passenger_name,
+            "confirmation_number": self.confirmation_number,
+            "seat_number": self.seat_number,
+            "flight_number": self.flight_number,
+            "account_number": self.account_number,
+        }
+
 def create_initial_context() -> AirlineAgentContext:
     """Create a new context with random account number."""
     ctx = AirlineAgentContext()
     ctx.account_number = str(random.randint(10000000, 99999999))
     return ctx
 
+# Global cap on in-flight upstream calls
+MAX_CONCURRENT_REQUESTS = 32
+
 class OpenRouterClient:
     """Simple OpenRouter API client."""
     
     def __init__(self):
         if not OPENROUTER_API_KEY:
             raise ValueError("OPENROUTER_API_KEY environment variable is not set")
+        self._client: Optional[httpx.AsyncClient] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._batches: set = set()
     
-    def chat_completion(self, messages: List[Dict[str, Any]], model: str = "deepseek/deepseek-chat-v3-0324:free") -> str:
-        """Call OpenRouter API and return the response content."""
-        try:
-            response = requests.post(
-                "https://openrouter.ai/api/v1/chat/completions",
+    def start(self):
+        """Open the pooled HTTP client and start the worker that dispatches queued requests."""
+        if self._client is None:
+            # Shared across calls so TCP/TLS sessions are reused
+            self._client = httpx.AsyncClient(
+                base_url="https://openrouter.ai",
                 headers={
                     "Authorization": f"Bearer {OPENROUTER_API_KEY}",
                     "Content-Type": "application/json",
                 },
-                json={
-                    "model": model,
-                    "messages": messages,
-                },
-                verify=False
+                http2=True,
+                timeout=60,
+                limits=httpx.Limits(max_keepalive_connections=100),
+            )
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+    
+    async def chat_completion(self, messages: List[Dict[str, Any]], model: str = "deepseek/deepseek-chat-v3-0324:free") -> str:
+        """Queue a call to OpenRouter API and return the response content."""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((messages, model, future))
+        return await future
+    
+    async def _run(self):
+        """Drain whatever is already queued and dispatch it as one concurrent batch."""
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self._queue.get()]
+            while not self._queue.empty():
+                items.append(self._queue.get_nowait())
+            # Dispatch without waiting so a slow batch does not hold back the next one
+            batch = loop.create_task(self._dispatch_batch(items))
+            self._batches.add(batch)
+            batch.add_done_callback(self._batches.discard)
+    
+    async def _dispatch_batch(self, items: List[tuple]):
+        """Dispatch a batch of queued requests concurrently."""
+        await asyncio.gather(*(self._dispatch(*item) for item in items))
+    
+    async def _dispatch(self, messages: List[Dict[str, Any]], model: str, future: asyncio.Future):
+        """Send a single queued request and resolve its future."""
+        try:
+            if future.cancelled():
+                return
+            async with self._semaphore:
+                if future.cancelled():
+                    return
+                result = await self._post(messages, model)
+            if not future.done():
+                future.set_result(result)
+        except asyncio.CancelledError:
+            if not future.done():
+                future.set_exception(Exception("OpenRouter client was closed"))
+            raise
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+    
+    async def _post(self, messages: List[Dict[str, Any]], model: str) -> str:
+        """Call OpenRouter API and return the response content."""
+        try:
+            response = await self._client.post(
+                "/api/v1/chat/completions",
+                content=orjson.dumps({"model": model, "messages": messages}),
             )
             response.raise_for_status()
-            data = response.json()
+            data = orjson.loads(response.content)
             return data['choices'][0]['message']['content']
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             raise Exception(f"Error calling OpenRouter API: {e}")
-        except (KeyError, IndexError) as e:
+        except (KeyError, IndexError, orjson.JSONDecodeError) as e:
             raise Exception(f"Error parsing OpenRouter response: {e}")
 
+    async def aclose(self):
+        """Stop the worker, fail pending calls and close the pooled HTTP connections."""
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        batches = list(self._batches)
+        for batch in batches:
+            batch.cancel()
+        await asyncio.gather(*batches, return_exceptions=True)
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, _, future = self._queue.get_nowait()
+                if not future.done():
+                    future.set_exception(Exception("OpenRouter client was closed"))
+            self._queue = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
 # Global OpenRouter client
 openrouter_client = OpenRouterClient()
 
+# Keywords an agent response must contain to be treated as a handoff request
+_HANDOFF_KEYWORD_RE = re.compile("transfer|handoff", re.IGNORECASE)
+
+# Seat tokens such as "12C" or "C12" in a customer message
+_SEAT_RE = re.compile(r"\b(\d{1,2}[A-Za-z]|[A-Za-z]\d{1,2})\b")
+
+# Fixed replies for tools that only trigger UI, so no follow-up LLM call is made
+_UI_TOOL_RESPONSES = {
+    "display_seat_map": "Here is the seat map.",
+}
+
+# Number of prior messages sent upstream as context; callers keep history in a deque of this size
+HISTORY_WINDOW = 10
+
 class Agent:
     """Simple agent class."""
     
@@ -71,26 +180,60 @@ class Agent:
         self.instructions = instructions
         self.tools = tools or []
         self.handoffs = []
+        self._handoff_re: Optional[re.Pattern] = None
+        self._handoff_map: Dict[str, "Agent"] = {}
+        self._rebuild_system_message()
     
-    def process_message(self, message: str, context: AirlineAgentContext, conversation_history: List[Dict]) -> Dict:
-        """Process a message and return response with events."""
-        
-        # Build system message with instructions and available tools
+    def _rebuild_system_message(self):
+        """Cache the system message built from instructions and tools; call again if tools change."""
         system_message = self.instructions
         if self.tools:
-            tool_descriptions = []
-            for tool in self.tools:
-                tool_descriptions.append(f"- {tool.__name__}: {tool.__doc__}")
+            tool_descriptions = [f"- {tool.__name__}: {tool.__doc__}" for tool in self.tools]
             system_message += f"\n\nAvailable tools:\n" + "\n".join(tool_descriptions)
             system_message += "\n\nTo use a tool, respond with: TOOL:<tool_name>(<arguments>)"
+        self._system_message = system_message
+    
+    def _rebuild_handoff_matcher(self):
+        """Compile a single pattern matching any handoff target name; call again if handoffs change."""
+        if self.handoffs:
+            names = "|".join(re.escape(agent.name) for agent in self.handoffs)
+            self._handoff_re = re.compile(f"({names})", re.IGNORECASE)
+        else:
+            self._handoff_re = None
+        self._handoff_map = {agent.name.lower(): agent for agent in self.handoffs}
+    
+    async def _run_tool(self, tool_name: str, message: str, context: AirlineAgentContext) -> Any:
+        """Execute a tool, awaiting it if it is a coroutine (e.g. a real API lookup)."""
+        # Simplified - in real implementation would parse arguments
+        if tool_name == "faq_lookup_tool":
+            tool_result = faq_lookup_tool(message)
+        elif tool_name == "update_seat":
+            # Extract seat from message
+            seat_match = _SEAT_RE.search(message)
+            seat = seat_match.group(1) if seat_match else "1A"
+            tool_result = update_seat(context, context.confirmation_number or "ABC123", seat)
+        elif tool_name == "flight_status_tool":
+            tool_result = flight_status_tool(context.flight_number or "FLT-123")
+        elif tool_name == "display_seat_map":
+            tool_result = display_seat_map(context)
+        elif tool_name == "cancel_flight":
+            tool_result = cancel_flight(context)
+        else:
+            tool_result = "Tool executed successfully"
+        if inspect.isawaitable(tool_result):
+            tool_result = await tool_result
+        return tool_result
+    
+    async def process_message(self, message: str, context: AirlineAgentContext, conversation_history: Sequence[Dict]) -> Dict:
+        """Process a message and return response with events."""
         
         # Build messages for API call
-        messages = [{"role": "system", "content": system_message}]
-        messages.extend(conversation_history[-10:])  # Last 10 messages for context
+        messages = [{"role": "system", "content": self._system_message}]
+        messages.extend(conversation_history)  # Rolling window of the last HISTORY_WINDOW messages
         messages.append({"role": "user", "content": message})
         
         # Get response from OpenRouter
-        response = openrouter_client.chat_completion(messages)
+        response = await openrouter_client.chat_completion(messages)
         
         events = []
         final_response = response
@@ -104,55 +247,35 @@ class Agent:
                 # Find and execute tool
                 tool_func = next((t for t in self.tools if t.__name__ == tool_name), None)
                 if tool_func:
-                    events.append({
-                        "type": "tool_call",
-                        "agent": self.name,
-                        "content": tool_name
-                    })
+                    tool_result = await self._run_tool(tool_name, message, context)
+                    events.extend((
+                        {"type": "tool_call", "agent": self.name, "content": tool_name},
+                        {"type": "tool_output", "agent": self.name, "content": str(tool_result)},
+                    ))
                     
-                    # Execute tool (simplified - in real implementation would parse arguments)
-                    if tool_name == "faq_lookup_tool":
-                        tool_result = faq_lookup_tool(message)
-                    elif tool_name == "update_seat":
-                        # Extract seat from message
-                        words = message.split()
-                        seat = next((w for w in words if len(w) <= 3 and any(c.isdigit() for c in w) and any(c.isalpha() for c in w)), "1A")
-                        tool_result = update_seat(context, context.confirmation_number or "ABC123", seat)
-                    elif tool_name == "flight_status_tool":
-                        tool_result = flight_status_tool(context.flight_number or "FLT-123")
-                    elif tool_name == "display_seat_map":
-                        tool_result = display_seat_map(context)
-                    elif tool_name == "cancel_flight":
-                        tool_result = cancel_flight(context)
+                    if tool_name in _UI_TOOL_RESPONSES:
+                        # UI-trigger tools need no follow-up LLM call; the frontend renders from the event
+                        final_response = _UI_TOOL_RESPONSES[tool_name]
                     else:
-                        tool_result = "Tool executed successfully"
-                    
-                    events.append({
-                        "type": "tool_output",
-                        "agent": self.name,
-                        "content": str(tool_result)
-                    })
-                    
-                    # Get final response after tool execution
-                    messages.append({"role": "assistant", "content": response})
-                    messages.append({"role": "user", "content": f"Tool result: {tool_result}. Please provide a response to the customer."})
-                    final_response = openrouter_client.chat_completion(messages)
+                        # Get final response after tool execution
+                        messages.append({"role": "assistant", "content": response})
+                        messages.append({"role": "user", "content": f"Tool result: {tool_result}. Please provide a response to the customer."})
+                        final_response = await openrouter_client.chat_completion(messages)
             except Exception as e:
                 final_response = "I apologize, but I encountered an error while processing your request."
         
         # Check for handoff requests
         handoff_agent = None
-        if "transfer" in final_response.lower() or "handoff" in final_response.lower():
-            for agent in self.handoffs:
-                if agent.name.lower() in final_response.lower():
-                    handoff_agent = agent
-                    events.append({
-                        "type": "handoff",
-                        "agent": self.name,
-                        "content": f"{self.name} -> {agent.name}",
-                        "metadata": {"source_agent": self.name, "target_agent": agent.name}
-                    })
-                    break
+        if self._handoff_re and _HANDOFF_KEYWORD_RE.search(final_response):
+            match = self._handoff_re.search(final_response)
+            if match:
+                handoff_agent = self._handoff_map[match.group(1).lower()]
+                events.append({
+                    "type": "handoff",
+                    "agent": self.name,
+                    "content": f"{self.name} -> {handoff_agent.name}",
+                    "metadata": {"source_agent": self.name, "target_agent": handoff_agent.name}
+                })
         
         return {
             "response": final_response,
@@ -164,7 +287,7 @@ class Agent:
 def faq_lookup_tool(question: str) -> str:
     """Lookup frequently asked questions."""
     q = question.lower()
-    if "bag" in q or "baggage" in q:
+    if "bag" in q:  # also covers "baggage"
         return "You are allowed to bring one bag on the plane. It must be under 50 pounds and 22 inches x 14 inches x 9 inches."
     elif "seats" in q or "plane" in q:
         return "There are 120 seats on the plane. There are 22 business class seats and 98 economy seats. Exit rows are rows 4 and 16. Rows 5-8 are Economy Plus, with extra legroom."
@@ -273,24 +396,44 @@ flight_status_agent.handoffs = [triage_agent]
 cancellation_agent.handoffs = [triage_agent]
 faq_agent.handoffs = [triage_agent]
 
+def _finalize_agents():
+    """Precompute per-agent matchers once handoff relationships are set."""
+    for agent in (triage_agent, seat_booking_agent, flight_status_agent, cancellation_agent, faq_agent):
+        agent._rebuild_handoff_matcher()
+
+_finalize_agents()
+
+_AGENT_REGISTRY: Dict[str, Agent] = {
+    "Triage Agent": triage_agent,
+    "Seat Booking Agent": seat_booking_agent,
+    "Flight Status Agent": flight_status_agent,
+    "Cancellation Agent": cancellation_agent,
+    "FAQ Agent": faq_agent,
+}
+
 def get_agent_by_name(name: str) -> Agent:
     """Get agent by name."""
-    agents = {
-        "Triage Agent": triage_agent,
-        "Seat Booking Agent": seat_booking_agent,
-        "Flight Status Agent": flight_status_agent,
-        "Cancellation Agent": cancellation_agent,
-        "FAQ Agent": faq_agent,
-    }
-    return agents.get(name, triage_agent)
+    return _AGENT_REGISTRY.get(name, triage_agent)
+
+def _setup_seat_booking_context(context: AirlineAgentContext):
+    """Assign a fresh flight and confirmation number for seat booking."""
+    context.flight_number = f"FLT-{random.randint(100, 999)}"
+    context.confirmation_number = "".join(random.choices(string.ascii_uppercase + string.digits, k=6))
+
+def _setup_cancellation_context(context: AirlineAgentContext):
+    """Fill in any missing confirmation or flight number for cancellation."""
+    if not context.confirmation_number:
+        context.confirmation_number = "".join(random.choices(string.ascii_uppercase + string.digits, k=6))
+    if not context.flight_number:
+        context.flight_number = f"FLT-{random.randint(100, 999)}"
+
+_CONTEXT_SETUP: Dict[str, Callable[[AirlineAgentContext], None]] = {
+    "Seat Booking Agent": _setup_seat_booking_context,
+    "Cancellation Agent": _setup_cancellation_context,
+}
 
 def setup_context_for_agent(context: AirlineAgentContext, agent_name: str):
     """Setup context when switching to specific agents."""
-    if agent_name == "Seat Booking Agent":
-        context.flight_number = f"FLT-{random.randint(100, 999)}"
-        context.confirmation_number = "".join(random.choices(string.ascii_uppercase + string.digits, k=6))
-    elif agent_name == "Cancellation Agent":
-        if not context.confirmation_number:
-            context.confirmation_number = "".join(random.choices(string.ascii_uppercase + string.digits, k=6))
-        if not context.flight_number:
-            context.flight_number = f"FLT-{random.randint(100, 999)}"
+    setup = _CONTEXT_SETUP.get(agent_name)
+    if setup:
+        setup(context)